@@ -1,11 +1,20 @@
 #!/usr/bin/env python
+import asyncio
+import os
 import logging
 import argparse
+import atexit
+import collections
 import datetime
+import itertools
+import math
+import queue
+import shlex
+import shutil
+import signal
 import subprocess
-import tempfile
 
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
 
 from pathlib import Path
 
@@ -17,12 +26,99 @@ from redbird.repos import MemoryRepo
 
 
 class LagunaCamException(Exception):
-    pass
+    def __init__(self, message, error):
+        super().__init__(message, error)
+        self.message = message
+        self.error = error
+
+    def __str__(self):
+        e = self.error
+        if isinstance(e, OSError):
+            return f"{self.message}. {e}"
+        if isinstance(e, subprocess.TimeoutExpired):
+            return f"{self.message}. Command was: {e.cmd}. Timed out after {e.timeout} seconds."
+        # the error output is only decoded when the exception is actually logged
+        error_output = e.stderr.decode(errors="replace")
+        return f"{self.message}. Command was: {e.cmd}. Exit code: {e.returncode}.\nError output: {error_output}"
+
+
+class DeferredQueueHandler(QueueHandler):
+    def prepare(self, record):
+        # formatting, including decoding error output, is left to the listener thread
+        return record
+
+
+# libcamera-vid replaces raspivid on current raspberry pi os
+LIBCAMERA_VID = shutil.which("libcamera-vid")
+RASPIVID = "/opt/vc/bin/raspivid"
+TASKSET = shutil.which("taskset")
+# the software encoder leaves the first core to the camera and the upload
+CPUS = os.cpu_count() or 1
+ENCODER_CPUS = max(1, CPUS - 1)
+
+FPS = 25
+BITRATE = 15_000_000
+TIMESTAMP_FORMAT = "%Y-%m-%d-%H_%M_%S"
+# how many times the recording duration the encoder may still need after the camera
+ENCODER_TIMEOUT_FACTOR = 10
+
+# USER = "laboratoriolaguna.net"
+# SERVER = "ssh.gb.stackcp.com"
+# UPLOAD_DIRECTORY = "public_html/web/files/videos"
+USER = "stahl"
+SERVER = "10.35.0.182"
+UPLOAD_DIRECTORY = "temp/venedig"
+
+SSH = (
+    "ssh",
+    "-o",
+    "StrictHostKeyChecking=no",
+    "-o",
+    "UserKnownHostsFile=/dev/null",
+    "-c",
+    "aes128-gcm@openssh.com",
+)
+# the control socket keeps the ssh connection open between uploads
+SSH_CONTROL = (
+    "-o",
+    "ControlMaster=auto",
+    "-o",
+    "ControlPath=/tmp/ssh-%r@%h:%p",
+    "-o",
+    "ControlPersist=600",
+)
+# every part of a parallel upload gets its own tcp connection, a multiplexed
+# control socket would squeeze them all through a single stream again
+SSH_PART = (*SSH, "-o", "ControlPath=none")
+
+# --partial/--append-verify resume an interrupted transfer
+RSYNC_BASE = ("rsync", "-a", "--partial", "--append-verify", "--inplace")
+RSYNC = (*RSYNC_BASE, "-e", " ".join((*SSH, *SSH_CONTROL)))
+RSYNC_PART = (*RSYNC_BASE, "-e", " ".join(SSH_PART))
+UPLOAD_ATTEMPTS = 3
+UPLOAD_RETRY_DELAY = 30
+
+FFMPEG_BASE = (
+    "ffmpeg",
+    "-y",
+    "-hide_banner",
+    "-nostats",
+    "-loglevel",
+    "error",
+    "-fflags",
+    "+genpts",
+    "-f",
+    "h264",
+    "-r",
+    f"{FPS}",  # raw h264 has no timestamps, assign the recorded fps
+    "-i",
+    "pipe:0",
+)
 
 
 app = Rocketry(
     config={
-        "task_execution": "main",
+        "task_execution": "async",
         "silence_task_prerun": True,
         "silence_task_logging": True,
         "silence_cond_check": True,
@@ -76,6 +172,19 @@ def parse_args():
         type=int,
         help="Setup time in seconds. Default 120",
     )
+    parser.add_argument(
+        "--upload-streams",
+        default=1,
+        type=int,
+        choices=range(1, 9),
+        metavar="[1-8]",
+        help="Upload large videos in this many parallel parts. Default 1",
+    )
+    parser.add_argument(
+        "--reencode",
+        action="store_true",
+        help="Re-encode the recording instead of copying the h264 stream into the mp4",
+    )
 
     args = parser.parse_args()
 
@@ -99,18 +208,159 @@ def parse_args():
         args.duration,
         args.size,
         args.setup_time,
+        args.reencode,
+        args.upload_streams,
     )
 
 
-def record(width, height, duration):
-    fps = 25
-    bitrate = int(15e6)
+async def wait(process, command):
+    # stderr is streamed and only its last lines are kept for the error message
+    stderr = collections.deque(maxlen=20)
+    async for line in process.stderr:
+        stderr.append(line)
+    await process.wait()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(
+            process.returncode, command, stderr=b"".join(stderr)
+        )
 
-    with tempfile.NamedTemporaryFile(
-        delete=False, mode="w+", suffix=".h264"
-    ) as output_path:
-        command = [
-            "/opt/vc/bin/raspivid",
+
+async def spawn(command, stdin=None, stdout=asyncio.subprocess.DEVNULL):
+    # every process gets its own session, so a kill also reaches its children
+    return await asyncio.create_subprocess_exec(
+        *command,
+        stdin=stdin,
+        stdout=stdout,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=True,
+    )
+
+
+async def run(command):
+    process = await spawn(command)
+    try:
+        await wait(process, command)
+    except asyncio.CancelledError:
+        # a cancelled command must not keep running in the background
+        kill(process)
+        await process.wait()
+        raise
+
+
+async def resume(command):
+    # a failed rsync is started again and continues where the last attempt stopped
+    for attempt in range(1, UPLOAD_ATTEMPTS + 1):
+        try:
+            await run(command)
+            return
+        except subprocess.CalledProcessError as e:
+            if attempt == UPLOAD_ATTEMPTS:
+                raise
+            log.warning(
+                "Upload attempt %d of %d failed with exit code %d, resuming in %d seconds",
+                attempt,
+                UPLOAD_ATTEMPTS,
+                e.returncode,
+                UPLOAD_RETRY_DELAY,
+            )
+            await asyncio.sleep(UPLOAD_RETRY_DELAY)
+
+
+def find_encoder():
+    # prefer the hardware encoders of the pi (v4l2m2m on pi 4, omx on older raspbian)
+    hardware_encoders = ["h264_v4l2m2m", "h264_omx"]
+    try:
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-encoders"],
+            check=True,
+            capture_output=True,
+        )
+        available = result.stdout.decode()
+    except (OSError, subprocess.CalledProcessError):
+        available = ""
+
+    for encoder in hardware_encoders:
+        if f" {encoder} " in available:
+            return ["-c:v", encoder, "-b:v", f"{BITRATE}"]
+
+    # veryfast gives much smaller files than ultrafast for little extra time
+    return [
+        "-c:v",
+        "libx264",
+        "-preset",
+        "veryfast",
+        "-crf",
+        "23",
+        # a keyframe every second and no b-frames, like the camera stream.
+        # no -tune zerolatency, its sliced threads would undo -thread_type frame
+        "-g",
+        f"{FPS}",
+        "-bf",
+        "0",
+        "-threads",
+        f"{ENCODER_CPUS}",  # 3 on a pi 4, 1 on a pi zero
+        "-thread_type",
+        "frame",
+    ]
+
+
+async def record(output_path, width, height, duration, encoder, timestamp):
+    # libcamera-vid muxes the hardware encoded h264 into the mp4 itself
+    libcamera_command = [
+        LIBCAMERA_VID,
+        "-t",
+        f"{duration}",
+        "--width",
+        f"{width}",
+        "--height",
+        f"{height}",
+        "--framerate",
+        f"{FPS}",
+        "--bitrate",
+        f"{BITRATE}",
+        "--intra",
+        f"{FPS}",
+        "--inline",
+        "--profile",
+        "baseline",
+        "--codec",
+        "libav",
+        "--libav-format",
+        "mp4",
+        "-o",
+        str(output_path),
+    ]
+
+    # the camera writes to stdout and is piped straight into ffmpeg,
+    # the video is never buffered in an intermediate .h264 file.
+    # a keyframe every second, inline headers and no b-frames in the baseline
+    # profile keep the stream trivial to mux with -c copy
+    if LIBCAMERA_VID:
+        record_command = [
+            LIBCAMERA_VID,
+            "-t",
+            f"{duration}",
+            "--width",
+            f"{width}",
+            "--height",
+            f"{height}",
+            "--framerate",
+            f"{FPS}",
+            "--bitrate",
+            f"{BITRATE}",
+            "--intra",
+            f"{FPS}",
+            "--inline",
+            "--profile",
+            "baseline",
+            "--codec",
+            "h264",
+            "-o",
+            "-",
+        ]
+    else:
+        record_command = [
+            RASPIVID,
             "-t",
             f"{duration}",
             "-w",
@@ -118,150 +368,335 @@ def record(width, height, duration):
             "-h",
             f"{height}",
             "-fps",
-            f"{fps}",
+            f"{FPS}",
             "-b",
-            f"{bitrate}",
+            f"{BITRATE}",
+            "-g",
+            f"{FPS}",
+            "-ih",
+            "-pf",
+            "baseline",
             "-o",
-            output_path.name,
+            "-",
         ]
 
+    if encoder:
+        codec = [*encoder, "-pix_fmt", "yuv420p"]
+    else:
+        # the camera already delivers h264, so only the container has to change
+        codec = ["-c", "copy"]
+
+    # keep the software encoder off the first core, the camera and the upload
+    # keep running there while the encoder saturates the others
+    if encoder and "libx264" in encoder and TASKSET and CPUS > 1:
+        pinning = [TASKSET, "-c", f"1-{CPUS - 1}"]
+    else:
+        pinning = []
+
+    encode_command = [
+        *pinning,
+        *FFMPEG_BASE,
+        *codec,
+        "-movflags",
+        "+faststart",
+        str(output_path),
+    ]
+
+    processes = []
+    tasks = []
+    try:
+        log.info("Start recording %s at %s", output_path, timestamp)
         try:
-            timestamp = datetime.datetime.now().strftime("%Y-%m-%d-%H_%M_%S")
-            log.info(f"Start recording {output_path.name} at {timestamp}")
-            subprocess.run(
-                command,
-                check=True,
-                capture_output=True,
+            if LIBCAMERA_VID and not encoder:
+                processes.append((await spawn(libcamera_command), libcamera_command))
+            else:
+                read_fd, write_fd = os.pipe()
+                try:
+                    recorder = await spawn(record_command, stdout=write_fd)
+                    processes.append((recorder, record_command))
+                    encoder_process = await spawn(encode_command, stdin=read_fd)
+                    processes.append((encoder_process, encode_command))
+                finally:
+                    # only the children may hold the pipe, otherwise ffmpeg never sees EOF
+                    os.close(read_fd)
+                    os.close(write_fd)
+
+            tasks = [
+                asyncio.create_task(wait(process, command))
+                for process, command in processes
+            ]
+            await supervise(
+                tasks, commands=[command for _, command in processes], duration=duration
             )
-            log.info(f"Successfully recorded {output_path.name}")
-        except subprocess.CalledProcessError as e:
-            Path(output_path.name).unlink(missing_ok=True)
-            raise LagunaCamException(
-                f"Unable to record video. Command was: {e.cmd}. Exit code: {e.returncode}.\nError output: {e.stderr.decode()}"
+        finally:
+            await stop(processes, tasks)
+        # writing the file out to the sd card takes a while, keep the loop free
+        await asyncio.to_thread(drop_cache, output_path)
+        log.info("Successfully recorded %s", output_path)
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError) as e:
+        output_path.unlink(missing_ok=True)
+        raise LagunaCamException("Unable to record video", e)
+
+    return output_path
+
+
+async def supervise(tasks, commands, duration):
+    # a hanging camera must not block the next interval forever. once the camera
+    # is done the encoder gets its own, generous deadline, a software encoder
+    # slower than real time is no hang but a stuck hardware encoder is
+    loop = asyncio.get_running_loop()
+    camera = tasks[0]
+    camera_running = True
+    timeout = duration / 1000 + 10
+    deadline = loop.time() + timeout
+    pending = set(tasks)
+    while pending:
+        if camera_running and camera.done():
+            camera_running = False
+            timeout = duration / 1000 * ENCODER_TIMEOUT_FACTOR + 10
+            deadline = loop.time() + timeout
+        done, pending = await asyncio.wait(
+            pending,
+            timeout=deadline - loop.time(),
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+        if not done:
+            running = next(
+                command for task, command in zip(tasks, commands) if not task.done()
             )
+            raise subprocess.TimeoutExpired(running, timeout)
+        for task in done:
+            task.result()
 
-        return output_path
 
+def kill(process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+async def stop(processes, tasks):
+    # once one process failed, none of the others may keep writing the output
+    for process, _ in processes:
+        if process.returncode is None:
+            kill(process)
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for process, _ in processes:
+        await process.wait()
+
+
+def drop_cache(path):
+    # the recording is read exactly once more by the upload, there is no point
+    # in keeping it in the page cache of the pi while it waits in the queue.
+    # the kernel only drops clean pages, so the file is written out first
+    if not hasattr(os, "posix_fadvise"):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fdatasync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
 
-def encode(input_path):
-    with tempfile.NamedTemporaryFile(
-        delete=False, mode="w+", suffix=".mp4"
-    ) as output_path:
 
-        command = [
-            "ffmpeg",
-            "-y",
-            "-i",
-            str(input_path.name),
-            # "-preset",
-            # "ultrafast",
-            # "-qp",
-            # "0",
-            str(output_path.name),
-        ]
+def video_paths(count):
+    # the same few files are reused for every recording instead of creating
+    # a new temporary file each interval
+    directory = Path("./videos")
+    # a directory of the service next to ./logs, so videos left over by a
+    # killed or restarted service are removed on the next start
+    shutil.rmtree(directory, ignore_errors=True)
+    directory.mkdir(parents=True, exist_ok=True)
+    atexit.register(shutil.rmtree, directory, ignore_errors=True)
+    return itertools.cycle([directory / f"video{i}.mp4" for i in range(count)])
 
-        try:
-            log.info(f"Start encoding {output_path.name}")
-            subprocess.run(
-                command,
-                check=True,
-                capture_output=True,
-            )
-            log.info(f"Successfully encoded {output_path.name}")
-        except subprocess.CalledProcessError as e:
-            Path(output_path.name).unlink(missing_ok=True)
-            raise LagunaCamException(
-                f"Unable to encode video. Command was: {e.cmd}. Exit code: {e.returncode}.\nError output: {e.stderr.decode()}"
-            )
-        finally:
-            Path(input_path.name).unlink(missing_ok=True)
 
-        return output_path
+def upload_parts(file_size, streams, part_size=16 * 1024 * 1024):
+    # parallel streams only pay off once a file is larger than a single part
+    return max(1, min(streams, math.ceil(file_size / part_size)))
+
+
+async def remove_remote_parts(remote_parts):
+    # the parts of a failed upload are not left behind on the server
+    try:
+        await run([*SSH, *SSH_CONTROL, f"{USER}@{SERVER}", f"rm -f {remote_parts}"])
+    except (subprocess.CalledProcessError, OSError) as e:
+        log.warning(LagunaCamException("Unable to remove uploaded parts", e))
 
 
-def upload(input_path):
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d-%H_%M_%S")
+async def upload(input_path, timestamp, streams):
     filename = f"laboratorio_laguna_cam_{timestamp}.mp4"
 
-    # user = "laboratoriolaguna.net"
-    # server = "ssh.gb.stackcp.com"
-    # upload_relative_path = f"public_html/web/files/videos/{filename}"
-    user = "stahl"
-    server = "10.35.0.182"
-    upload_relative_path = f"temp/venedig/{filename}"
+    upload_relative_path = f"{UPLOAD_DIRECTORY}/{filename}"
 
-    destination = f"{user}@{server}:{upload_relative_path}"
+    destination = f"{USER}@{SERVER}:{upload_relative_path}"
 
-    command = [
-        "scp",
-        "-o",
-        "StrictHostKeyChecking=no",
-        "-o",
-        "UserKnownHostsFile=/dev/null",
-        str(input_path.name),
-        destination,
-    ]
+    part_paths = []
 
     try:
-        log.info(f"Uploading {input_path.name} to {destination}")
-        subprocess.run(
-            command,
-            check=True,
-            capture_output=True,
-        )
-        log.info(f"Successfully uploaded {filename}")
-    except subprocess.CalledProcessError as e:
-        raise LagunaCamException(
-            f"Unable to upload video. Command was: {e.cmd}. Exit code: {e.returncode}.\nError output: {e.stderr.decode()}"
-        )
+        log.info("Uploading %s to %s", input_path, destination)
+        parts = upload_parts(input_path.stat().st_size, streams)
+        part_paths = [Path(f"{input_path}.part{i:02d}") for i in range(parts)]
+        if parts == 1:
+            await resume([*RSYNC, str(input_path), destination])
+        else:
+            await run(
+                [
+                    "split",
+                    "-d",
+                    "-n",
+                    f"{parts}",
+                    str(input_path),
+                    f"{input_path}.part",
+                ]
+            )
+            remote_parts = " ".join(
+                shlex.quote(f"{upload_relative_path}{part_path.suffix}")
+                for part_path in part_paths
+            )
+            tasks = [
+                asyncio.create_task(
+                    resume(
+                        [
+                            *RSYNC_PART,
+                            str(part_path),
+                            f"{destination}{part_path.suffix}",
+                        ]
+                    )
+                )
+                for part_path in part_paths
+            ]
+            try:
+                try:
+                    await asyncio.gather(*tasks)
+                finally:
+                    # once one part gave up the others are stopped, before their
+                    # local files are removed
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                await run(
+                    [
+                        *SSH,
+                        *SSH_CONTROL,
+                        f"{USER}@{SERVER}",
+                        f"cat {remote_parts} > {shlex.quote(upload_relative_path)} && rm {remote_parts}",
+                    ]
+                )
+            except (subprocess.CalledProcessError, OSError):
+                await remove_remote_parts(remote_parts)
+                raise
+        log.info("Successfully uploaded %s", filename)
+    except (subprocess.CalledProcessError, OSError) as e:
+        raise LagunaCamException("Unable to upload video", e)
     finally:
-        Path(input_path.name).unlink(missing_ok=True)
+        for part_path in part_paths:
+            part_path.unlink(missing_ok=True)
+        input_path.unlink(missing_ok=True)
 
     return filename
 
 
-def create_video_task(size=Arg("size"), duration=Arg("duration")):
+async def create_video_task(
+    size=Arg("size"),
+    duration=Arg("duration"),
+    encoder=Arg("encoder"),
+    upload_queue=Arg("upload_queue"),
+    recording_paths=Arg("recording_paths"),
+):
+    timestamp = datetime.datetime.now().strftime(TIMESTAMP_FORMAT)
     try:
-        filename = record(width=size[0], height=size[1], duration=duration)
-        filename = encode(filename)
-        filename = upload(filename)
+        filename = await record(
+            next(recording_paths),
+            width=size[0],
+            height=size[1],
+            duration=duration,
+            encoder=encoder,
+            timestamp=timestamp,
+        )
     except LagunaCamException as e:
         log.error(e)
     else:
-        log.info(f"Successfully created {filename}")
+        # waits if uploading falls behind, the camera is free for the next interval
+        await upload_queue.put((filename, timestamp))
+
+
+async def upload_worker(upload_queue, streams):
+    while True:
+        filename, timestamp = await upload_queue.get()
+        try:
+            filename = await upload(filename, timestamp=timestamp, streams=streams)
+        except LagunaCamException as e:
+            log.error(e)
+        except Exception:
+            # the worker must outlive a single broken upload, otherwise the queue
+            # fills up and recording stops for good
+            log.exception("Unexpected error while uploading %s", filename)
+        else:
+            log.info("Successfully created %s", filename)
+        finally:
+            upload_queue.task_done()
 
 
 def startup(width, height, setup_time):
-    fps = 25
-    bitrate = int(15e6)
     duration = setup_time * 1000
-    command = [
-        "/opt/vc/bin/raspivid",
-        "-t",
-        f"{duration}",
-        "-w",
-        f"{width}",
-        "-h",
-        f"{height}",
-        "-fps",
-        f"{fps}",
-        "-b",
-        f"{bitrate}",
-    ]
+    if LIBCAMERA_VID:
+        command = [
+            LIBCAMERA_VID,
+            "-t",
+            f"{duration}",
+            "--width",
+            f"{width}",
+            "--height",
+            f"{height}",
+            "--framerate",
+            f"{FPS}",
+            "--bitrate",
+            f"{BITRATE}",
+        ]
+    else:
+        command = [
+            RASPIVID,
+            "-t",
+            f"{duration}",
+            "-w",
+            f"{width}",
+            "-h",
+            f"{height}",
+            "-fps",
+            f"{FPS}",
+            "-b",
+            f"{BITRATE}",
+        ]
     try:
         log.info(
-            f"Start camera output for manual focus setup for {int(duration/1000)} seconds."
+            "Start camera output for manual focus setup for %d seconds.", setup_time
         )
         subprocess.run(
             command,
             check=True,
-            capture_output=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
         )
-        log.info(f"Manual setup phase done.")
+        log.info("Manual setup phase done.")
     except subprocess.CalledProcessError as e:
-        raise LagunaCamException(
-            f"Unable to complete setup phase. Command was: {e.cmd}. Exit code: {e.returncode}.\nError output: {e.stderr.decode()}"
+        raise LagunaCamException("Unable to complete setup phase", e)
+
+
+def start_ssh_master():
+    command = [*SSH, *SSH_CONTROL, "-M", "-N", "-f", f"{USER}@{SERVER}"]
+    try:
+        log.info("Opening ssh connection to %s", SERVER)
+        subprocess.run(
+            command,
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
         )
+    except subprocess.CalledProcessError as e:
+        # not fatal, the next upload opens the connection on its own
+        log.warning(LagunaCamException("Unable to open ssh connection", e))
 
 
 if __name__ == "__main__":
@@ -271,20 +706,30 @@ if __name__ == "__main__":
         duration,
         size,
         setup_time,
+        reencode,
+        upload_streams,
     ) = parse_args()
 
     # setup log
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d-%H_%M_%S")
+    console = logging.StreamHandler()
     logging.basicConfig(
         format="%(levelname)s:%(asctime)s %(message)s",
         datefmt="%m/%d/%Y %I:%M:%S %p",
         level=log_level,
+        handlers=[console],
     )
     log = logging.getLogger("lagunacam")
     Path("./logs").mkdir(parents=True, exist_ok=True)
     logfile = Path("./logs/lagunacam.log")
     handler = TimedRotatingFileHandler(logfile, when="d", interval=3, backupCount=5)
-    log.addHandler(handler)
+    # console and file are written from a background thread, the lagunacam
+    # logger only enqueues its records
+    log_queue = queue.Queue(-1)
+    log.addHandler(DeferredQueueHandler(log_queue))
+    log.propagate = False
+    listener = QueueListener(log_queue, console, handler)
+    listener.start()
+    atexit.register(listener.stop)
 
     startup(
         width=size[0],
@@ -292,12 +737,38 @@ if __name__ == "__main__":
         setup_time=setup_time,
     )  # startup is called once to manually setup the camera focus
 
-    # start recurring task
-    app.params(
-        size=size,
-        duration=duration,
-    )
-    app.session.create_task(
-        start_cond=interval, name="create a video", func=create_video_task
-    )
-    app.run()
+    start_ssh_master()
+
+    encoder = None
+    if reencode:
+        encoder = find_encoder()
+        log.info("Using encoder %s", " ".join(encoder))
+
+    async def main():
+        # recording and uploading run as a pipeline, so the camera does not
+        # wait for the network and vice versa
+        upload_queue = asyncio.Queue(maxsize=2)
+        # one file is recorded, one uploaded and the rest wait in the queue
+        recording_paths = video_paths(upload_queue.maxsize + 2)
+        workers = [
+            asyncio.create_task(upload_worker(upload_queue, upload_streams)),
+        ]
+
+        # start recurring task
+        app.params(
+            size=size,
+            duration=duration,
+            encoder=encoder,
+            upload_queue=upload_queue,
+            recording_paths=recording_paths,
+        )
+        app.session.create_task(
+            start_cond=interval, name="create a video", func=create_video_task
+        )
+        try:
+            await app.serve()
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    asyncio.run(main())